@@ -32,7 +32,8 @@ transformer = TransformerDecoder(
           num_heads=args.num_heads,
           num_layers=args.num_layers,
           max_length=30,
-          device = device
+          device = device,
+          compile_model=True
         )
 
 trainer = Trainer(transformer, train_dataloader, val_dataloader,
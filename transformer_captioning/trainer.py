@@ -6,7 +6,7 @@ import torch
 
 class Trainer(object):
 
-    def __init__(self, model, train_dataloader, val_dataloader, learning_rate = 0.001, num_epochs = 10, print_every = 10, verbose = True, device = 'cuda'):
+    def __init__(self, model, train_dataloader, val_dataloader, learning_rate = 0.001, num_epochs = 10, print_every = 10, verbose = True, device = 'cuda', mixed_precision = True):
       
         self.model = model
         self.train_dataloader = train_dataloader
@@ -18,6 +18,7 @@ class Trainer(object):
         self.loss_history = []
         self.val_loss_history = []
         self.device = device
+        self.mixed_precision = mixed_precision # run forward passes under bfloat16 autocast
         self.optim = torch.optim.Adam(self.model.parameters(), self.learning_rate)
 
     def loss(self, predictions, labels):
@@ -32,6 +33,12 @@ class Trainer(object):
 
         loss = criterion(predictions, labels)
         return loss
+
+    def autocast(self):
+        """
+        Autocast context for forward passes: matmuls run in bfloat16, while numerically sensitive ops (LayerNorm, softmax, loss) stay in float32.
+        """
+        return torch.autocast(device_type=torch.device(self.device).type, dtype=torch.bfloat16, enabled=self.mixed_precision)
     
     def val(self):
         """
@@ -42,9 +49,10 @@ class Trainer(object):
         num_batches = 0
         for batch in self.val_dataloader:
             features, captions = batch[0].to(self.device), batch[1].to(self.device)
-            logits = self.model(features, captions[:, :-1])
+            with self.autocast():
+                logits = self.model(features, captions[:, :-1])
 
-            loss = self.loss(logits, captions[:, 1:])
+                loss = self.loss(logits, captions[:, 1:])
             val_loss += loss.detach().cpu().numpy()
             num_batches += 1
 
@@ -60,9 +68,10 @@ class Trainer(object):
             num_batches = 0
             for batch in self.train_dataloader:
                 features, captions = batch[0].to(self.device), batch[1].to(self.device)
-                logits = self.model(features, captions[:, :-1])
+                with self.autocast():
+                    logits = self.model(features, captions[:, :-1])
 
-                loss = self.loss(logits, captions[:, 1:])
+                    loss = self.loss(logits, captions[:, 1:])
                 self.optim.zero_grad()
                 loss.backward()
                 self.optim.step()
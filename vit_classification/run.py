@@ -23,7 +23,8 @@ transformer = ViT(
                 num_layers=4,
                 num_patches=16,
                 num_classes=10,
-                device=device
+                device=device,
+                compile_model=True
             )
 trainer = Trainer(transformer, train_dataloader, test_dataloader, learning_rate=1e-4, batch_size=64, print_every=1, num_epochs=100)
 trainer.train()
@@ -5,7 +5,7 @@ from vit import ViT
 
 class Trainer:
     def __init__(self, model, train_dataloader, test_dataloader, learning_rate = 0.001, batch_size = 100, 
-            num_epochs = 10, print_every = 10, save_every=10, verbose = True, device = 'cuda'):
+            num_epochs = 10, print_every = 10, save_every=10, verbose = True, device = 'cuda', mixed_precision = True):
       
         self.model = model
         self.train_dataloader = train_dataloader
@@ -18,11 +18,18 @@ class Trainer:
         self.verbose = verbose 
         self.loss_history = []
         self.device = device
+        self.mixed_precision = mixed_precision # run forward passes under bfloat16 autocast
         self.optim = torch.optim.Adam(self.model.parameters(), self.learning_rate)
         self.scheduler = torch.optim.lr_scheduler.CosineAnnealingWarmRestarts(self.optim, T_0=10, T_mult=1, eta_min=1e-6)
         self.test_accuracy_history = [[], []]
         self.train_accuracy_history = [[], []]
 
+    def autocast(self):
+        """
+            Autocast context for forward passes: matmuls and convolutions run in bfloat16, while numerically sensitive ops (LayerNorm, softmax, loss) stay in float32.
+        """
+        return torch.autocast(device_type=torch.device(self.device).type, dtype=torch.bfloat16, enabled=self.mixed_precision)
+
     def eval(self, dataloader):
         total_datapoints = 0
         correct_predictions = 0
@@ -30,7 +37,7 @@ class Trainer:
         self.model.eval()
 
         for images, labels in dataloader:
-            with torch.no_grad():
+            with torch.no_grad(), self.autocast():
                 logits = self.model(images.to(self.device))
             predictions = torch.argmax(logits, dim=1)
             correct_predictions += torch.sum(predictions == labels.to(self.device)).item()
@@ -60,9 +67,10 @@ class Trainer:
             for images, labels in self.train_dataloader:
                 images = images.to(self.device)
                 labels = labels.to(self.device)
-                logits = self.model(images)
+                with self.autocast():
+                    logits = self.model(images)
 
-                loss = self.loss(logits, labels)
+                    loss = self.loss(logits, labels)
                 
                 self.optim.zero_grad()
                 loss.backward()
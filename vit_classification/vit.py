@@ -31,7 +31,7 @@ class ViT(nn.Module):
         - The output embedding corresponding to the [CLS] token is then fed through a linear layer to obtain the logits for each class.
     """
 
-    def __init__(self, patch_dim, d_model, d_ff, num_heads, num_layers, num_patches, num_classes, device = 'cuda'):
+    def __init__(self, patch_dim, d_model, d_ff, num_heads, num_layers, num_patches, num_classes, device = 'cuda', compile_model=False, learnable_positions=True):
         """
             Construct a new ViT instance.
             Inputs
@@ -41,6 +41,8 @@ class ViT(nn.Module):
             - num_heads: the number of heads in the multi head attention layer
             - num_layers: the number of transformer blocks
             - num_patches: the number of patches in the image
+            - compile_model: If True, compile forward with torch.compile (TorchInductor + CUDA graphs)
+            - learnable_positions: If False, use fixed sinusoidal position encodings instead of learnable ones
         """
 
         super().__init__()
@@ -55,10 +57,15 @@ class ViT(nn.Module):
         self.device = device
         
         # TODO - Initialize following layers
-        """Patch Embedding Layer"""
-        self.patch_embedding = nn.Linear(patch_dim*patch_dim*3, d_model) # Linear Layer that takes as input a patch (patch_dim*patch_dim*3) and outputs a d_model dimensional vector
+        """Patch Embedding Layer
+        - A Linear layer over flattened (patch_dim*patch_dim*3) patches is equivalent to a Conv2d with kernel_size = stride = patch_dim,
+            which embeds every patch directly from the image without materializing the patch tensor."""
+        self.patch_embed_conv = nn.Conv2d(3, d_model, kernel_size=patch_dim, stride=patch_dim) # (N, 3, H, W) -> (N, d_model, H/patch_dim, W/patch_dim)
+        self.patch_embed_conv = self.patch_embed_conv.to(memory_format=torch.channels_last) # NHWC weights let cuDNN pick tensor-core conv kernels
         """Positional Encoding Layer"""
-        self.positional_encoding = PositionalEncoding(embed_dim=d_model, dropout=0.1, max_len=5000) # positional encoding
+        self.positional_encoding = PositionalEncoding(embed_dim=d_model, dropout=0.1, max_len=5000, learnable=learnable_positions) # positional encoding
+        """Final Layer Normalization; with Pre-LN blocks the residual stream is otherwise never normalized"""
+        self.layernorm = nn.LayerNorm(normalized_shape=d_model, elementwise_affine=True)
         """Final Linear Classification Layer"""
         self.fc = nn.Linear(d_model, num_classes)# takes as input the embedding corresponding to the [CLS] token and outputs the logits for each class
         """CLS Token Embedding
@@ -75,22 +82,9 @@ class ViT(nn.Module):
         self.device = device 
         self.to(device)
 
-    def patchify(self, images):
-        """
-            Given a batch of images, divide each image into patches and flatten each patch into a vector.
-            Inputs:
-                - images: a FloatTensor of shape (N, 3, H, W) giving a minibatch of images
-            Returns:
-                - patches: a FloatTensor of shape (N, num_patches, patch_dim x patch_dim x 3) giving a minibatch of patches    
-        """
-
-        # TODO - Break images into a grid of patches
-        """Patchify K (patch_dim x patch_dim) patches from each image in the batch."""
-        N,C,H,W = images.shape # N = batch size, C = num channels, H = height, W = width
-        patches = images.unfold(dimension=2, size=self.patch_dim, step=self.patch_dim).unfold(dimension=3, size=self.patch_dim, step=self.patch_dim) # (N, C, num_vertical_slices, num_horizontal_slices, patch_dim, patch_dim)
-        patches.permute(0, 2, 3, 1, 4, 5) # (N, num_vertical_slices, num_horizontal_slices, C, patch_dim, patch_dim)
-        patches = patches.reshape(N, -1, self.patch_dim * self.patch_dim * C) # (N, num_vertical_slices * num_horizontal_slices = num_patches, patch_dim * patch_dim * C)
-        return patches
+        if compile_model:
+            """Fuse the many small pointwise ops with TorchInductor and capture CUDA graphs to remove kernel-launch overhead"""
+            self.forward = torch.compile(self.forward, mode='reduce-overhead', fullgraph=False, dynamic=False)
 
     def forward(self, images):
         """
@@ -101,27 +95,26 @@ class ViT(nn.Module):
                 - logits: a FloatTensor of shape (N, C) giving the logits for each class
         """
         
-        """Patchify input images (e.g. 16 8x8 patches per 32x32 image)"""
-        patches = self.patchify(images) # (N, num_patches, patch_dim * patch_dim * C)
-        """Generate an embedding vector per patch (e.g. 1x256 embedding vector per patch)"""
-        patches_embedded = self.patch_embedding(patches) # (N, num_patches, d_model)
+        """Patchify input images (e.g. 16 8x8 patches per 32x32 image) and generate an embedding vector per patch (e.g. 1x256 embedding vector per patch)"""
+        images = images.contiguous(memory_format=torch.channels_last) # (N, 3, H, W) stored as NHWC to match the conv weights
+        patches_embedded = self.patch_embed_conv(images) # (N, d_model, num_vertical_slices, num_horizontal_slices); channels_last
+        patches_embedded = patches_embedded.flatten(2).transpose(1, 2) # (N, num_vertical_slices * num_horizontal_slices = num_patches, d_model); contiguous view of the NHWC output, no copy
         
         # TODO - Append a CLS token to the beginning of the sequence of patch embeddings
         """Append a CLS token of shape (N=1,1,d_model) to the beginning of the sequence of patch embeddings of shape (N, num_patches, d_model)"""
-        cls_token_repeat = self.cls_token.repeat(patches_embedded.shape[0], 1, 1) # (1, 1, d_model) -> (N, 1, d_model)
-        output = torch.cat((cls_token_repeat, patches_embedded), dim=1) # (N, num_patches + 1, d_model)
-
-        output = self.positional_encoding(patches_embedded)
-        mask = torch.ones((self.num_patches, self.num_patches), device=self.device)
+        cls_token_expand = self.cls_token.to(patches_embedded.dtype).expand(patches_embedded.shape[0], -1, -1) # (1, 1, d_model) -> (N, 1, d_model); zero-stride view, no copy; matches the (autocast) dtype of the patch embeddings
+        output = torch.cat((cls_token_expand, patches_embedded), dim=1) # (N, num_patches + 1, d_model)
 
+        output = self.positional_encoding(output) # (N, num_patches + 1, d_model)
+        """Every patch (and the [CLS] token) attends to every other, so no mask is needed; this keeps SDPA on its mask-free fast path"""
         for layer in self.layers:
-            output = layer(output, mask)
+            output = layer(output, None)
 
         # TODO (take the embedding corresponding to the [CLS] token and feed it through a linear layer to obtain the logits for each class)
         """Extract embedding vector corresponding to the [CLS] token; 
         Remember that the [CLS] embedding is the first embedding in the sequence of patch embeddings"""
         cls_embedding = output[:, 0, :] # (N, d_model)
-        output = self.fc(cls_embedding) # (N, num_classes)
+        output = self.fc(self.layernorm(cls_embedding)) # (N, num_classes)
 
         return output
 
@@ -129,13 +122,15 @@ class ViT(nn.Module):
         """
         Initialize the weights of the network.
         """
-        if isinstance(module, (nn.Linear, nn.Embedding)):
+        if isinstance(module, (nn.Linear, nn.Conv2d, nn.Embedding)):
             module.weight.data.normal_(mean=0.0, std=0.02)
-            if isinstance(module, nn.Linear) and module.bias is not None:
+            if isinstance(module, (nn.Linear, nn.Conv2d)) and module.bias is not None:
                 module.bias.data.zero_()
         elif isinstance(module, nn.LayerNorm):
             module.bias.data.zero_()
             module.weight.data.fill_(1.0)
+        elif isinstance(module, PositionalEncoding) and module.learnable:
+            module.pos_table.data.normal_(mean=0.0, std=0.02)
 
 
 